@@ -0,0 +1,45 @@
+"""
+Kernels numéricos compilados con Numba (dependencia opcional).
+Si Numba no está instalado, adjust_bc es None.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+# Tipos de entrada para los que adjust_bc está compilado
+ADJUST_BC_DTYPES = (np.dtype(np.uint16), np.dtype(np.float32))
+
+
+if njit is not None:
+    # Firmas explícitas: se compila al importar (y se guarda en caché
+    # en disco), así el primer frame no paga el JIT
+    @njit(
+        [
+            "void(uint16[:, :, ::1], float64, float64, uint8[:, :, ::1])",
+            "void(float32[:, :, ::1], float64, float64, uint8[:, :, ::1])",
+        ],
+        parallel=True, fastmath=True, cache=True, boundscheck=False,
+    )
+    def adjust_bc(img, alpha, beta, out):
+        """
+        Calcula out = saturar(|alpha * img + beta|) en uint8.
+        
+        Args:
+            img: Imagen de entrada (alto, ancho, canales), C-contigua
+            alpha: Factor de contraste
+            beta: Valor de brillo
+            out: Buffer uint8 C-contiguo de la misma forma que img
+        """
+        H, W, C = img.shape
+        for i in prange(H):
+            for j in range(W):
+                for c in range(C):
+                    v = abs(alpha * img[i, j, c] + beta)
+                    out[i, j, c] = 255 if v >= 255.0 else np.uint8(round(v))
+else:
+    adjust_bc = None
@@ -8,10 +8,21 @@ Fecha: 2025
 import cv2
 import numpy as np
 import logging
-from typing import Optional, Tuple
+import sys
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
 from dataclasses import dataclass
 from pathlib import Path
 
+from _kernels import ADJUST_BC_DTYPES, adjust_bc
+
+# Configurar logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class ImageSettings:
@@ -23,23 +34,43 @@ class ImageSettings:
 class WebcamCapture:
     """Clase para manejar la captura de webcam y procesamiento de imágenes."""
     
-    def __init__(self, camera_index: int = 0):
+    # Parámetros JPEG: calidad por defecto de imwrite, sin segunda pasada Huffman
+    jpeg_params = [cv2.IMWRITE_JPEG_QUALITY, 95, cv2.IMWRITE_JPEG_OPTIMIZE, 0]
+    # Número máximo de tablas de consulta en caché
+    lut_cache_size: int = 512
+    
+    def __init__(self, camera_index: int = 0,
+                 output_dir: Union[str, Path] = "output"):
         """
         Inicializa la captura de webcam.
         
         Args:
             camera_index: Índice de la cámara (0 por defecto)
+            output_dir: Directorio donde se guardan las imágenes
         """
         self.camera_index = camera_index
+        self.output_dir = output_dir
         self.cap: Optional[cv2.VideoCapture] = None
         self.is_initialized = False
+        # Pasa a False cuando la cámara deja de entregar frames
+        self._capturing = False
         
-        # Configurar logging
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
-        self.logger = logging.getLogger(__name__)
+        # Tablas de consulta de brillo/contraste por (contraste, brillo)
+        self._lut_cache: "OrderedDict[Tuple[float, float], np.ndarray]" = OrderedDict()
+        
+        # Buffer reutilizable para la imagen procesada
+        self._processed_buf: Optional[np.ndarray] = None
+    
+    @property
+    def output_dir(self) -> Path:
+        """Directorio donde se guardan las imágenes."""
+        return self._output_dir
+    
+    @output_dir.setter
+    def output_dir(self, value: Union[str, Path]):
+        # Un directorio nuevo se vuelve a crear en el siguiente guardado
+        self._output_dir = Path(value)
+        self._output_dir_created = False
     
     def initialize_camera(self) -> bool:
         """
@@ -49,24 +80,56 @@ class WebcamCapture:
             bool: True si la inicialización fue exitosa
         """
         try:
-            self.cap = cv2.VideoCapture(self.camera_index)
+            # En Linux se prefiere V4L2 para que CAP_PROP_BUFFERSIZE se respete
+            self.cap = None
+            if sys.platform.startswith("linux"):
+                self.cap = cv2.VideoCapture(self.camera_index, cv2.CAP_V4L2)
+            
+            # Sin V4L2 (o fuera de Linux): backend por defecto de OpenCV
+            if self.cap is None or not self.cap.isOpened():
+                self.cap = cv2.VideoCapture(self.camera_index)
             
             if not self.cap.isOpened():
-                self.logger.error(f"No se pudo abrir la cámara {self.camera_index}")
+                logger.error("No se pudo abrir la cámara %s", self.camera_index)
                 return False
             
+            # Cola de un solo buffer: evita leer frames viejos ya encolados
+            if not self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1):
+                logger.warning(
+                    "El backend no admite CAP_PROP_BUFFERSIZE; "
+                    "se usará la cola por defecto del driver"
+                )
+            
+            # Pedir MJPG al driver: mucho menos ancho de banda USB que YUYV
+            fourcc = cv2.VideoWriter_fourcc(*"MJPG")
+            self.cap.set(cv2.CAP_PROP_FOURCC, fourcc)
+            if int(self.cap.get(cv2.CAP_PROP_FOURCC)) != fourcc:
+                logger.warning(
+                    "La cámara no admite MJPG; se usará el formato por defecto"
+                )
+            
             # Configurar resolución (opcional)
             self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
             self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
             
             self.is_initialized = True
-            self.logger.info("Cámara inicializada correctamente")
+            self._capturing = True
+            logger.info("Cámara inicializada correctamente")
             return True
             
         except Exception as e:
-            self.logger.error(f"Error al inicializar cámara: {e}")
+            logger.error("Error al inicializar cámara: %s", e)
             return False
     
+    def is_capturing(self) -> bool:
+        """
+        Indica si la cámara está abierta y entregando frames.
+        
+        Returns:
+            bool: False si no está inicializada o si falló la última lectura
+        """
+        return self.is_initialized and self._capturing
+    
     def capture_frame(self) -> Optional[np.ndarray]:
         """
         Captura un frame de la webcam.
@@ -75,37 +138,163 @@ class WebcamCapture:
             np.ndarray o None: Frame capturado o None si hay error
         """
         if not self.is_initialized or self.cap is None:
-            self.logger.warning("Cámara no inicializada")
+            logger.warning("Cámara no inicializada")
             return None
         
         try:
             ret, frame = self.cap.read()
             if not ret:
-                self.logger.warning("No se pudo capturar frame")
+                logger.warning("No se pudo capturar frame")
+                self._capturing = False
                 return None
             
             return frame
             
         except Exception as e:
-            self.logger.error(f"Error al capturar frame: {e}")
+            logger.error("Error al capturar frame: %s", e)
+            self._capturing = False
             return None
     
+    def capture_frame_grab(self) -> bool:
+        """
+        Avanza al siguiente frame de la webcam sin decodificarlo.
+        
+        Returns:
+            bool: True si se obtuvo un frame
+        """
+        if not self.is_initialized or self.cap is None:
+            logger.warning("Cámara no inicializada")
+            return False
+        
+        try:
+            if not self.cap.grab():
+                logger.warning("No se pudo obtener frame")
+                self._capturing = False
+                return False
+            
+            return True
+            
+        except Exception as e:
+            logger.error("Error al obtener frame: %s", e)
+            self._capturing = False
+            return False
+    
+    def retrieve_frame(self) -> Optional[np.ndarray]:
+        """
+        Decodifica el último frame obtenido con capture_frame_grab.
+        
+        Returns:
+            np.ndarray o None: Frame decodificado o None si hay error
+        """
+        if not self.is_initialized or self.cap is None:
+            logger.warning("Cámara no inicializada")
+            return None
+        
+        try:
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                logger.warning("No se pudo decodificar frame")
+                self._capturing = False
+                return None
+            
+            return frame
+            
+        except Exception as e:
+            logger.error("Error al decodificar frame: %s", e)
+            self._capturing = False
+            return None
+    
+    def _get_lut(self, alpha: float, beta: float) -> np.ndarray:
+        """
+        Obtiene la tabla de consulta para un contraste y brillo dados.
+        
+        Args:
+            alpha: Factor de contraste
+            beta: Valor de brillo
+            
+        Returns:
+            np.ndarray: Tabla de 256 entradas uint8
+        """
+        # Redondear la clave absorbe el error acumulado de pasos como 0.1
+        key = (round(alpha, 6), round(beta, 6))
+        lut = self._lut_cache.get(key)
+        if lut is not None:
+            self._lut_cache.move_to_end(key)
+            return lut
+        
+        # Misma saturación que convertScaleAbs: |contraste * x + brillo|
+        values = np.arange(256, dtype=np.float64) * alpha
+        values += beta
+        lut = np.clip(np.rint(np.abs(values)), 0, 255).astype(np.uint8)
+        
+        self._lut_cache[key] = lut
+        if len(self._lut_cache) > self.lut_cache_size:
+            self._lut_cache.popitem(last=False)
+        
+        return lut
+    
+    def _get_processed_buf(self, image: np.ndarray) -> np.ndarray:
+        """
+        Devuelve el buffer de salida, recreándolo si cambia la forma.
+        
+        Args:
+            image: Imagen de entrada
+            
+        Returns:
+            np.ndarray: Buffer uint8 con la forma de la imagen
+        """
+        if self._processed_buf is None or self._processed_buf.shape != image.shape:
+            self._processed_buf = np.empty(image.shape, dtype=np.uint8)
+        
+        return self._processed_buf
+    
     def adjust_brightness_contrast(self, image: np.ndarray, 
-                                 settings: ImageSettings) -> np.ndarray:
+                                 settings: ImageSettings,
+                                 full_res: bool = True) -> np.ndarray:
         """
         Ajusta brillo y contraste de una imagen.
         
         Args:
             image: Imagen de entrada
             settings: Configuración de ajustes
+            full_res: Si es False y la imagen tiene 480 filas o más, se
+                procesa y devuelve a media resolución (para vistas previas)
             
         Returns:
-            np.ndarray: Imagen procesada
+            np.ndarray: Imagen procesada. Es un buffer interno que se
+            sobrescribe en la siguiente llamada; copiarlo si debe conservarse.
+            Con contraste 1.0 y brillo 0 en uint8 se devuelve la propia
+            imagen de entrada, sin copiarla.
         """
         try:
+            if not full_res and image.shape[0] >= 480:
+                # Vista previa: un cuarto de los píxeles, visualmente equivalente
+                image = cv2.resize(image, None, fx=0.5, fy=0.5,
+                                   interpolation=cv2.INTER_AREA)
+            
+            # Ajuste identidad: no hay nada que calcular
+            if (image.dtype == np.uint8 and settings.contrast == 1.0
+                    and settings.brightness == 0.0):
+                return image
+            
+            dst = self._get_processed_buf(image)
+            
+            if image.dtype == np.uint8:
+                # Sólo hay 256 valores posibles: aplicar la tabla precalculada
+                lut = self._get_lut(settings.contrast, settings.brightness)
+                return cv2.LUT(image, lut, dst=dst)
+            
+            if (adjust_bc is not None and image.ndim == 3
+                    and image.dtype in ADJUST_BC_DTYPES):
+                # Tipos más anchos (p. ej. 16 bits): kernel Numba en paralelo
+                adjust_bc(np.ascontiguousarray(image), float(settings.contrast),
+                          float(settings.brightness), dst)
+                return dst
+            
             # Aplicar ajustes: nueva_imagen = contraste * imagen + brillo
             adjusted = cv2.convertScaleAbs(
                 image, 
+                dst=dst,
                 alpha=settings.contrast,  # Factor de contraste
                 beta=settings.brightness  # Valor de brillo
             )
@@ -113,7 +302,7 @@ class WebcamCapture:
             return adjusted
             
         except Exception as e:
-            self.logger.error(f"Error al ajustar imagen: {e}")
+            logger.error("Error al ajustar imagen: %s", e)
             return image
     
     def save_image(self, image: np.ndarray, filename: str = "captured_image.jpg") -> bool:
@@ -128,47 +317,65 @@ class WebcamCapture:
             bool: True si se guardó correctamente
         """
         try:
-            # Crear directorio si no existe
-            output_path = Path("output")
-            output_path.mkdir(exist_ok=True)
+            # Crear directorio si no existe (sólo la primera vez)
+            if not self._output_dir_created:
+                self._output_dir.mkdir(parents=True, exist_ok=True)
+                self._output_dir_created = True
             
-            full_path = output_path / filename
-            success = cv2.imwrite(str(full_path), image)
+            full_path = self._output_dir / filename
+            success, buf = cv2.imencode(full_path.suffix, image, self.jpeg_params)
             
-            if success:
-                self.logger.info(f"Imagen guardada: {full_path}")
-                return True
-            else:
-                self.logger.error(f"Error al guardar imagen: {full_path}")
+            if not success:
+                logger.error("Error al codificar imagen: %s", full_path)
                 return False
+            
+            full_path.write_bytes(buf.tobytes())
+            logger.info("Imagen guardada: %s", full_path)
+            return True
                 
         except Exception as e:
-            self.logger.error(f"Error al guardar imagen: {e}")
+            logger.error("Error al guardar imagen: %s", e)
             return False
     
     def release_camera(self):
         """Libera los recursos de la cámara."""
         if self.cap is not None:
             self.cap.release()
+            self.cap = None
             self.is_initialized = False
-            self.logger.info("Cámara liberada")
+            self._capturing = False
+            logger.info("Cámara liberada")
 
 
 class WebcamApp:
     """Aplicación principal para captura automática de webcam."""
     
+    # Frames descartados (sin decodificar) antes de la captura real
+    flush_frames: int = 2
+    # Frames descartados tras abrir la cámara, mientras converge la exposición
+    warmup_frames: int = 5
+    
     def __init__(self):
         """Inicializa la aplicación."""
         self.webcam = WebcamCapture()
         self.settings = ImageSettings()
+        self._needs_warmup = True
     
     def setup(self) -> bool:
         """
-        Configura la aplicación.
+        Configura la aplicación. Si la cámara ya está abierta, se reutiliza.
         
         Returns:
             bool: True si la configuración fue exitosa
         """
+        if self.webcam.is_capturing():
+            return True
+        
+        # Liberar lo que quede de una cámara caída antes de reabrirla
+        if self.webcam.is_initialized:
+            self.webcam.release_camera()
+        
+        self._needs_warmup = True
         return self.webcam.initialize_camera()
     
 
@@ -186,24 +393,31 @@ class WebcamApp:
         if not self.setup():
             return False
         
-        try:
-            # Capturar frame
-            frame = self.webcam.capture_frame()
-            if frame is None:
+        # Descartar frames viejos (o de calentamiento) sin decodificarlos
+        if self._needs_warmup:
+            discard = self.warmup_frames
+            self._needs_warmup = False
+        else:
+            discard = self.flush_frames
+        
+        for _ in range(discard):
+            if not self.webcam.capture_frame_grab():
                 return False
-            
-            # Procesar imagen
-            processed_frame = self.webcam.adjust_brightness_contrast(
-                frame, self.settings
-            )
-            
-            # Guardar imagen
-            success = self.webcam.save_image(processed_frame, output_filename)
-            
-            return success
         
-        finally:
-            self.cleanup()
+        # Capturar frame
+        if not self.webcam.capture_frame_grab():
+            return False
+        frame = self.webcam.retrieve_frame()
+        if frame is None:
+            return False
+        
+        # Procesar imagen
+        processed_frame = self.webcam.adjust_brightness_contrast(
+            frame, self.settings
+        )
+        
+        # Guardar imagen
+        return self.webcam.save_image(processed_frame, output_filename)
     
     def cleanup(self):
         """Limpia recursos de la aplicación."""
@@ -236,7 +450,8 @@ def main():
         print(f"Capturando imagen...")
         
         if app.capture_single_image(filename):
-            print(f"✓ Imagen capturada exitosamente: output/{filename}")
+            print(f"✓ Imagen capturada exitosamente: "
+                  f"{app.webcam.output_dir / filename}")
             print(f"✓ Brillo aplicado: {app.settings.brightness}")
             print(f"✓ Contraste aplicado: {app.settings.contrast}")
         else:
@@ -250,6 +465,10 @@ def main():
         print(f"✗ Error inesperado: {e}")
         return 1
     
+    finally:
+        # La cámara queda abierta entre capturas; se libera al terminar
+        app.cleanup()
+    
     return 0
 
 